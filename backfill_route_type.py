@@ -0,0 +1,15 @@
+"""One-time migration for the by_type-updated_at index.
+
+Routes written before the index existed have no type attribute, so the
+list Query does not see them. Run this once against the DynamoDB table
+after the index is added:
+
+    python backfill_route_type.py
+"""
+import database as db
+
+
+if __name__ == '__main__':
+    db.init_db()
+    count = db.backfill_route_type()
+    print(f'[DB] Set type on {count} routes for index {db.ROUTES_INDEX}')
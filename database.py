@@ -1,34 +1,98 @@
+import atexit
+import signal
+import sys
 import uuid
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from decimal import Decimal
 
+import orjson
+
 TABLE_NAME = os.environ.get('DYNAMODB_TABLE', 'cyclemaps-routes')
 
+# Every DynamoDB route carries type=ROUTE_ITEM_TYPE so the whole collection can
+# be read with a Query on this index (sorted by updated_at) instead of a Scan
+ROUTES_INDEX = 'by_type-updated_at'
+ROUTE_ITEM_TYPE = 'route'
+
+# Attributes returned by list_routes (everything but the bulky fields)
+_LIST_FIELDS = ('id', 'name', 'description', 'route_type', 'tier', 'region', 'distance_km',
+                'elevation_m', 'center_lng', 'center_lat', 'created_at', 'updated_at')
+_LIST_PROJECTION = ('id, #n, description, route_type, tier, #r, distance_km, elevation_m, '
+                    'center_lng, center_lat, created_at, updated_at')
+
+# Route attributes stored as numbers; everything else is a string
+_FLOAT_FIELDS = ('distance_km', 'elevation_m', 'center_lng', 'center_lat')
+
+# Tables without ROUTES_INDEX are read with a parallel segmented Scan: one
+# segment per MB of table data, clamped to this range
+MIN_SCAN_SEGMENTS = 2
+MAX_SCAN_SEGMENTS = 8
+
+# Fold the local change log back into the snapshot after this many appends
+LOG_COMPACT_THRESHOLD = 500
+
+# Local change log records are queued in memory and written out by a background
+# thread at most this often (seconds), and on exit
+LOG_FLUSH_INTERVAL = 0.25
+
 # Storage backend: 'dynamodb' or 'local'
 _backend = None
 _table = None         # DynamoDB table (when using dynamodb backend)
-_local_file = None    # Path to JSON file (when using local backend)
+_has_routes_index = False  # Whether _table has ROUTES_INDEX (older tables may not)
+_scan_segments = MIN_SCAN_SEGMENTS  # TotalSegments for the Scan fallback
+_scan_executor = ThreadPoolExecutor(max_workers=MAX_SCAN_SEGMENTS, thread_name_prefix='scan')
+_local_file = None    # Path to JSON snapshot (when using local backend)
+_local_log = None     # Path to append-only change log next to the snapshot
+_local_log_count = 0  # Records appended since the last compaction
+_local_pending = []   # Serialized log lines not yet written to _local_log
+_local_dirty = threading.Event()  # Set when _local_pending has lines to flush
+_flush_thread = None
 _local_data = []      # In-memory store (when using local backend)
+_local_index = {}     # Route id -> position in _local_data
+_local_summaries = {} # Route id -> list_routes projection, in _local_data order
+_local_lock = threading.RLock()  # Keeps _local_data, _local_index and _local_summaries in step
+_geometry_valid = {}  # Route id -> (updated_at, whether geometry parses), either backend
 
 
 def init_db():
     """Initialize database. Uses DynamoDB if AWS credentials are available, otherwise falls back to local JSON file."""
-    global _backend, _table, _local_file, _local_data
+    global _backend, _table, _has_routes_index, _scan_segments, _local_file, _local_log, _local_data, _local_index, _local_summaries
 
     # Try DynamoDB first
     try:
         import boto3
+        from botocore.config import Config
         from botocore.exceptions import ClientError, NoCredentialsError, PartialCredentialsError
 
         region = os.environ.get('AWS_DEFAULT_REGION', 'us-west-1')
-        dynamodb = boto3.resource('dynamodb', region_name=region)
+        # One resource for the whole process; size its connection pool for
+        # concurrent request threads plus the parallel Scan workers
+        config = Config(
+            max_pool_connections=50,
+            retries={'mode': 'adaptive', 'max_attempts': 5},
+            tcp_keepalive=True,
+        )
+        dynamodb = boto3.resource('dynamodb', region_name=region, config=config)
         table = dynamodb.Table(TABLE_NAME)
         table.load()
         _table = table
+        _has_routes_index = any(
+            index['IndexName'] == ROUTES_INDEX for index in table.global_secondary_indexes or []
+        )
         _backend = 'dynamodb'
         print(f'[DB] Connected to DynamoDB table: {TABLE_NAME}')
+        # Routes written before the index existed have no type and are missing
+        # from the Query until backfill_route_type.py has been run once
+        if not _has_routes_index:
+            size_mb = (table.table_size_bytes or 0) // (1024 * 1024)
+            _scan_segments = max(MIN_SCAN_SEGMENTS, min(MAX_SCAN_SEGMENTS, size_mb))
+            print(f'[DB] Index {ROUTES_INDEX} not found, listing routes with '
+                  f'a {_scan_segments}-segment Scan')
         return
 
     except Exception as e:
@@ -39,11 +103,24 @@ def init_db():
                 table = dynamodb.create_table(
                     TableName=TABLE_NAME,
                     KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
-                    AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+                    AttributeDefinitions=[
+                        {'AttributeName': 'id', 'AttributeType': 'S'},
+                        {'AttributeName': 'type', 'AttributeType': 'S'},
+                        {'AttributeName': 'updated_at', 'AttributeType': 'S'},
+                    ],
+                    GlobalSecondaryIndexes=[{
+                        'IndexName': ROUTES_INDEX,
+                        'KeySchema': [
+                            {'AttributeName': 'type', 'KeyType': 'HASH'},
+                            {'AttributeName': 'updated_at', 'KeyType': 'RANGE'},
+                        ],
+                        'Projection': {'ProjectionType': 'ALL'},
+                    }],
                     BillingMode='PAY_PER_REQUEST',
                 )
                 table.wait_until_exists()
                 _table = table
+                _has_routes_index = True
                 _backend = 'dynamodb'
                 print(f'[DB] Created DynamoDB table: {TABLE_NAME}')
                 return
@@ -55,19 +132,177 @@ def init_db():
 
     # Local JSON file fallback
     _backend = 'local'
-    _local_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routes_data.json')
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    _local_file = os.path.join(base_dir, 'routes_data.json')
+    _local_log = os.path.join(base_dir, 'routes_data.log')
     if os.path.exists(_local_file):
         with open(_local_file, 'r') as f:
             _local_data = json.load(f)
     else:
         _local_data = []
+    _local_index = {item['id']: i for i, item in enumerate(_local_data)}
+    if os.path.exists(_local_log):
+        _replay_local_log()
+        _compact_local()
+    _local_summaries = {item['id']: _summarize(item) for item in _local_data}
+    _start_log_flusher()
     print(f'[DB] Local storage: {_local_file} ({len(_local_data)} routes)')
 
 
-def _save_local():
-    """Persist local data to JSON file."""
-    with open(_local_file, 'w') as f:
-        json.dump(_local_data, f, indent=2, default=str)
+def _summarize(item):
+    """The lightweight list_routes view of a route, built once per write."""
+    return {k: item[k] for k in _LIST_FIELDS if k in item}
+
+
+def _replay_local_log():
+    """Apply the records in the change log on top of the loaded snapshot."""
+    with open(_local_log, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final line from an interrupted write
+                continue
+            if record['op'] == 'put':
+                item = record['item']
+                i = _local_index.get(item['id'])
+                if i is None:
+                    _local_data.append(item)
+                    _local_index[item['id']] = len(_local_data) - 1
+                else:
+                    _local_data[i] = item
+            elif record['op'] == 'del':
+                i = _local_index.pop(record['id'], None)
+                if i is not None:
+                    _local_data.pop(i)
+                    for j in range(i, len(_local_data)):
+                        _local_index[_local_data[j]['id']] = j
+
+
+def _append_local(op, value):
+    """Queue a single put (full item) or del (route id) for the change log."""
+    global _local_log_count
+    record = {'op': op, 'item': value} if op == 'put' else {'op': op, 'id': value}
+    _local_pending.append(json.dumps(record, default=str) + '\n')
+    _local_dirty.set()
+    _local_log_count += 1
+    if _local_log_count >= LOG_COMPACT_THRESHOLD:
+        _compact_local()
+
+
+def _flush_log(sync=False):
+    """Write queued change log lines to disk, fsyncing them if sync is set."""
+    with _local_lock:
+        if not _local_pending:
+            return
+        with open(_local_log, 'a') as f:
+            f.write(''.join(_local_pending))
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        _local_pending.clear()
+
+
+def _flush_loop():
+    while True:
+        _local_dirty.wait()
+        time.sleep(LOG_FLUSH_INTERVAL)
+        with _local_lock:
+            _flush_log()
+            _local_dirty.clear()
+
+
+def _start_log_flusher():
+    """Start the background log writer and make sure queued lines are written on exit."""
+    global _flush_thread
+    if _flush_thread is not None:
+        return
+    _flush_thread = threading.Thread(target=_flush_loop, name='local-log-flush', daemon=True)
+    _flush_thread.start()
+    atexit.register(_flush_log, sync=True)
+    # A bare SIGTERM would skip atexit; servers such as gunicorn install their
+    # own handler, which exits cleanly, so only take over the default one
+    if (threading.current_thread() is threading.main_thread()
+            and signal.getsignal(signal.SIGTERM) is signal.SIG_DFL):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+def _compact_local():
+    """Atomically rewrite the snapshot from memory and truncate the change log."""
+    global _local_log_count
+    with _local_lock:
+        tmp_file = _local_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(_local_data, f, default=str)
+            # The snapshot replaces the only other copy of the data, so it
+            # must be on disk before the rename
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, _local_file)
+        open(_local_log, 'w').close()
+        _local_pending.clear()
+        _local_log_count = 0
+
+
+def has_valid_geometry(item):
+    """Whether a route's geometry is present and parses as JSON.
+
+    Geometry only changes on create/update, so the answer is remembered per
+    route id and reused until updated_at moves on. Only the flag is kept; the
+    parsed geometry itself is not held in memory.
+    """
+    cached = _geometry_valid.get(item['id'])
+    if cached and cached[0] == item.get('updated_at'):
+        return cached[1]
+    try:
+        valid = bool(item.get('geometry')) and orjson.loads(item['geometry']) is not None
+    except (orjson.JSONDecodeError, TypeError):
+        valid = False
+    _geometry_valid[item['id']] = (item.get('updated_at'), valid)
+    return valid
+
+
+def _to_dynamo(fields):
+    """Copy of fields with the float-valued attributes as Decimal, as DynamoDB requires."""
+    converted = dict(fields)
+    for key in _FLOAT_FIELDS:
+        converted[key] = Decimal(str(converted[key]))
+    return converted
+
+
+def backfill_route_type():
+    """Set type on every DynamoDB route that lacks it. Returns the number of routes updated.
+
+    A full-table Scan, so this is a one-time migration (backfill_route_type.py)
+    rather than something to run on every start.
+    """
+    if _backend != 'dynamodb':
+        return 0
+    from boto3.dynamodb.conditions import Attr
+    missing = _paginate(
+        _table.scan,
+        ProjectionExpression='id',
+        FilterExpression=Attr('type').not_exists(),
+    )
+    for item in missing:
+        try:
+            _table.update_item(
+                Key={'id': item['id']},
+                UpdateExpression='SET #t = :type',
+                ConditionExpression='attribute_exists(id)',
+                ExpressionAttributeNames={'#t': 'type'},
+                ExpressionAttributeValues={':type': ROUTE_ITEM_TYPE},
+            )
+        except _table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass  # Deleted since the scan
+    return len(missing)
+
+
+def _from_dynamo(item):
+    """Route dict from a DynamoDB item: floats instead of Decimals, without the index key."""
+    item = _convert_decimals(item)
+    item.pop('type', None)
+    return item
 
 
 def _convert_decimals(obj):
@@ -106,12 +341,15 @@ def create_route(data):
     }
 
     if _backend == 'dynamodb':
-        # Convert floats to Decimal for DynamoDB
-        dynamo_item = json.loads(json.dumps(item), parse_float=Decimal)
+        dynamo_item = _to_dynamo(item)
+        dynamo_item['type'] = ROUTE_ITEM_TYPE
         _table.put_item(Item=dynamo_item)
     else:
-        _local_data.append(item)
-        _save_local()
+        with _local_lock:
+            _local_data.append(item)
+            _local_index[item['id']] = len(_local_data) - 1
+            _local_summaries[item['id']] = _summarize(item)
+            _append_local('put', item)
 
     return item
 
@@ -121,44 +359,71 @@ def get_route(route_id):
     if _backend == 'dynamodb':
         resp = _table.get_item(Key={'id': route_id})
         item = resp.get('Item')
-        return _convert_decimals(item) if item else None
+        return _from_dynamo(item) if item else None
     else:
-        for item in _local_data:
-            if item['id'] == route_id:
-                return item
-        return None
+        with _local_lock:
+            i = _local_index.get(route_id)
+            return _local_data[i] if i is not None else None
+
+
+def _paginate(read, **kwargs):
+    """Call a Query/Scan method repeatedly until all pages have been read."""
+    resp = read(**kwargs)
+    items = resp.get('Items', [])
+    while 'LastEvaluatedKey' in resp:
+        resp = read(ExclusiveStartKey=resp['LastEvaluatedKey'], **kwargs)
+        items.extend(resp.get('Items', []))
+    return items
+
+
+def _fetch_all_routes(**kwargs):
+    """Read every route from DynamoDB.
+
+    Uses a Query on ROUTES_INDEX (most recently updated first) when the table
+    has it, otherwise falls back to a parallel segmented Scan.
+    """
+    if _has_routes_index:
+        from boto3.dynamodb.conditions import Key
+        return _paginate(
+            _table.query,
+            IndexName=ROUTES_INDEX,
+            KeyConditionExpression=Key('type').eq(ROUTE_ITEM_TYPE),
+            ScanIndexForward=False,
+            **kwargs,
+        )
+
+    futures = [
+        _scan_executor.submit(_paginate, _table.scan, Segment=segment,
+                              TotalSegments=_scan_segments, **kwargs)
+        for segment in range(_scan_segments)
+    ]
+    items = []
+    for future in futures:
+        items.extend(future.result())
+    return items
 
 
 def list_routes():
     """List all routes without geometry (lightweight)."""
     if _backend == 'dynamodb':
-        from botocore.exceptions import ClientError
-        resp = _table.scan(
-            ProjectionExpression='id, #n, description, route_type, tier, #r, distance_km, elevation_m, center_lng, center_lat, created_at, updated_at',
+        items = _fetch_all_routes(
+            ProjectionExpression=_LIST_PROJECTION,
             ExpressionAttributeNames={'#n': 'name', '#r': 'region'},
         )
-        items = resp.get('Items', [])
-        while 'LastEvaluatedKey' in resp:
-            resp = _table.scan(
-                ProjectionExpression='id, #n, description, route_type, tier, #r, distance_km, elevation_m, center_lng, center_lat, created_at, updated_at',
-                ExpressionAttributeNames={'#n': 'name', '#r': 'region'},
-                ExclusiveStartKey=resp['LastEvaluatedKey'],
-            )
-            items.extend(resp.get('Items', []))
-        return _convert_decimals(items)
+        return [_from_dynamo(item) for item in items]
     else:
-        return [{k: v for k, v in item.items() if k not in ('geometry', 'waypoints')} for item in _local_data]
+        with _local_lock:
+            return list(_local_summaries.values())
 
 
 def list_routes_with_geometry():
     """List all routes including geometry."""
     if _backend == 'dynamodb':
-        resp = _table.scan()
-        items = resp.get('Items', [])
-        while 'LastEvaluatedKey' in resp:
-            resp = _table.scan(ExclusiveStartKey=resp['LastEvaluatedKey'])
-            items.extend(resp.get('Items', []))
-        return _convert_decimals(items)
+        items = [_from_dynamo(item) for item in _fetch_all_routes()]
+        # Forget validity flags for routes deleted by other writers
+        for route_id in _geometry_valid.keys() - {item['id'] for item in items}:
+            _geometry_valid.pop(route_id, None)
+        return items
     else:
         return list(_local_data)
 
@@ -188,16 +453,17 @@ def update_route(route_id, data):
     }
 
     if _backend == 'dynamodb':
-        dynamo_fields = json.loads(json.dumps(update_fields), parse_float=Decimal)
+        dynamo_fields = _to_dynamo(update_fields)
         _table.update_item(
             Key={'id': route_id},
-            UpdateExpression='SET #n = :name, description = :description, route_type = :route_type, '
+            UpdateExpression='SET #t = :type, #n = :name, description = :description, route_type = :route_type, '
                              'tier = :tier, #r = :region, distance_km = :distance_km, elevation_m = :elevation_m, '
                              'geometry = :geometry, waypoints = :waypoints, center_lng = :center_lng, '
                              'center_lat = :center_lat, elevation_profile = :elevation_profile, '
                              'surface_data = :surface_data, updated_at = :updated_at',
-            ExpressionAttributeNames={'#n': 'name', '#r': 'region'},
+            ExpressionAttributeNames={'#t': 'type', '#n': 'name', '#r': 'region'},
             ExpressionAttributeValues={
+                ':type': ROUTE_ITEM_TYPE,
                 ':name': dynamo_fields['name'],
                 ':description': dynamo_fields['description'],
                 ':route_type': dynamo_fields['route_type'],
@@ -215,15 +481,45 @@ def update_route(route_id, data):
             },
         )
     else:
-        for i, item in enumerate(_local_data):
-            if item['id'] == route_id:
-                _local_data[i] = {**existing, **update_fields}
-                break
-        _save_local()
+        with _local_lock:
+            i = _local_index.get(route_id)
+            if i is None:
+                return None
+            _local_data[i] = {**existing, **update_fields}
+            _local_summaries[route_id] = _summarize(_local_data[i])
+            _append_local('put', _local_data[i])
 
     return {**existing, **update_fields}
 
 
+def set_surface_data(route_id, surface_data):
+    """Store a route's surface_data without touching its other fields or updated_at.
+
+    Returns True if the stored value changed, False if the route does not
+    exist or already holds this value.
+    """
+    if _backend == 'dynamodb':
+        try:
+            _table.update_item(
+                Key={'id': route_id},
+                UpdateExpression='SET surface_data = :s',
+                ConditionExpression='attribute_exists(id) AND '
+                                    '(attribute_not_exists(surface_data) OR surface_data <> :s)',
+                ExpressionAttributeValues={':s': surface_data},
+            )
+        except _table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+    else:
+        with _local_lock:
+            i = _local_index.get(route_id)
+            if i is None or _local_data[i].get('surface_data') == surface_data:
+                return False
+            _local_data[i] = {**_local_data[i], 'surface_data': surface_data}
+            _append_local('put', _local_data[i])
+            return True
+
+
 def delete_route(route_id):
     """Delete a route by ID. Returns True if deleted, False if not found."""
     if _backend == 'dynamodb':
@@ -231,11 +527,18 @@ def delete_route(route_id):
         if not existing:
             return False
         _table.delete_item(Key={'id': route_id})
+        _geometry_valid.pop(route_id, None)
         return True
     else:
-        for i, item in enumerate(_local_data):
-            if item['id'] == route_id:
-                _local_data.pop(i)
-                _save_local()
-                return True
-        return False
+        with _local_lock:
+            i = _local_index.pop(route_id, None)
+            if i is None:
+                return False
+            _local_data.pop(i)
+            # Shift the positions of everything after the removed route
+            for j in range(i, len(_local_data)):
+                _local_index[_local_data[j]['id']] = j
+            del _local_summaries[route_id]
+            _append_local('del', route_id)
+            _geometry_valid.pop(route_id, None)
+            return True
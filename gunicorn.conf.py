@@ -0,0 +1,12 @@
+# Gunicorn settings, picked up automatically by `gunicorn app:app` run from
+# this directory.
+import os
+
+# /api/elevation and /api/surface spend almost all of their time waiting on
+# Open-Meteo and Overpass, so serve requests from a thread pool rather than
+# tying up a whole sync worker per request
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+# Overpass queries can take up to 25s on their own
+timeout = 60
@@ -1,45 +1,180 @@
-import json
+import gzip
+import hashlib
+import math
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from xml.sax.saxutils import escape as xml_escape
 from flask import Blueprint, request, jsonify, Response
 import database as db
 
 api = Blueprint('api', __name__, url_prefix='/api')
 
+# Shared HTTP session for upstream APIs so concurrent requests reuse pooled
+# connections; keep at least one per server thread (see gunicorn.conf.py)
+_http = requests.Session()
+_http.mount('https://', HTTPAdapter(pool_connections=8,
+                                    pool_maxsize=int(os.environ.get('GUNICORN_THREADS', 32))))
+
+ELEVATION_MAX_WORKERS = 8  # Concurrent Open-Meteo batches per /elevation request
+
+
+# --- Read cache ---
+# The list endpoints are read-mostly, so keep their encoded responses in memory
+# for a short TTL. Entries are tagged with _version, which the mutating handlers
+# bump, and carry an ETag derived from the payload for conditional GETs plus a
+# gzipped copy, so compression happens once per refresh rather than per request.
+
+CACHE_TTL = 30  # seconds
+COMPRESS_MIN_SIZE = 1024  # bytes; smaller responses are sent uncompressed
+COMPRESS_LEVEL = 6  # gzip's usual default; level 9 costs far more CPU for little gain
+
+_cache = {}  # key -> (timestamp, version, payload, etag, gzipped payload or None)
+_cache_lock = threading.Lock()
+_version = 0
+
+
+def _cache_get(key):
+    """Return (payload, etag, gzipped) for key, or None if missing, expired or stale."""
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry and entry[1] == _version and time.monotonic() - entry[0] < CACHE_TTL:
+            return entry[2:]
+    return None
+
+
+def _cache_put(key, version, payload):
+    """Store payload unless a mutation happened since version was read. Returns its cache entry."""
+    etag = hashlib.blake2b(payload, digest_size=8).hexdigest()
+    gzipped = gzip.compress(payload, compresslevel=COMPRESS_LEVEL) if len(payload) >= COMPRESS_MIN_SIZE else None
+    with _cache_lock:
+        if version == _version:
+            _cache[key] = (time.monotonic(), version, payload, etag, gzipped)
+    return payload, etag, gzipped
+
+
+def _accepts_gzip():
+    # Membership alone would also match an explicit gzip;q=0 refusal
+    return request.accept_encodings['gzip'] > 0
+
+
+def _gzip_if_accepted(resp):
+    """Compress a buffered response in place when it is large and the client accepts gzip."""
+    resp.vary.add('Accept-Encoding')
+    if resp.content_length and resp.content_length >= COMPRESS_MIN_SIZE and _accepts_gzip():
+        resp.set_data(gzip.compress(resp.get_data(), compresslevel=COMPRESS_LEVEL))
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
+
+
+def _gzip_stream(chunks):
+    """Gzip a stream of byte chunks on the fly."""
+    compressor = zlib.compressobj(COMPRESS_LEVEL, wbits=31)  # 31 selects the gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _cached_response(payload, etag, gzipped):
+    """JSON response for a cached payload, or 304 if the client's copy matches."""
+    resp = Response(payload, mimetype='application/json')
+    resp.vary.add('Accept-Encoding')
+    if gzipped is not None and _accepts_gzip():
+        resp.set_data(gzipped)
+        resp.headers['Content-Encoding'] = 'gzip'
+        etag += '-gzip'  # Each encoding is a distinct representation
+    resp.set_etag(etag)
+    # Let browsers keep a copy but revalidate every time, so a route saved in
+    # the builder shows up immediately when returning to the viewer
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp.make_conditional(request)
+
+
+def _json_response(obj, status=200):
+    """Encode a (potentially large) payload with orjson instead of jsonify."""
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
+
+def _invalidate_cache():
+    global _version
+    with _cache_lock:
+        _version += 1
+        _cache.clear()
+
 
 # --- Route CRUD ---
 
 @api.route('/routes', methods=['GET'])
 def list_routes():
     """List all routes (lightweight — no geometry)."""
-    return jsonify(db.list_routes())
+    cached = _cache_get('routes')
+    if cached is None:
+        version = _version
+        cached = _cache_put('routes', version, orjson.dumps(db.list_routes()))
+    return _cached_response(*cached)
+
+
+def _serialize_feature(item):
+    """
+    Encode a route as a GeoJSON Feature. The stored geometry is already JSON
+    text, so it is spliced in verbatim instead of being parsed and re-encoded.
+    """
+    props = {k: v for k, v in item.items() if k not in ('geometry', 'waypoints')}
+    return b''.join((
+        b'{"type":"Feature","geometry":',
+        item['geometry'].encode(),
+        b',"properties":',
+        orjson.dumps(props),
+        b'}',
+    ))
 
 
 @api.route('/routes/geojson', methods=['GET'])
 def routes_geojson():
     """All routes as a GeoJSON FeatureCollection for the map."""
+    cached = _cache_get('geojson')
+    if cached is not None:
+        return _cached_response(*cached)
+
+    version = _version
     items = db.list_routes_with_geometry()
-    features = []
-    for item in items:
-        geometry_str = item.get('geometry', '')
-        if not geometry_str:
-            continue
-        try:
-            geometry = json.loads(geometry_str)
-        except (json.JSONDecodeError, TypeError):
-            continue
 
-        props = {k: v for k, v in item.items() if k not in ('geometry', 'waypoints')}
-        features.append({
-            'type': 'Feature',
-            'geometry': geometry,
-            'properties': props,
-        })
+    def stream():
+        # Emit the FeatureCollection one feature at a time; the chunks are kept
+        # so the full payload can be cached once the last one has been sent.
+        chunks = [b'{"type":"FeatureCollection","features":[']
+        yield chunks[0]
+        separator = b''
+        for item in items:
+            # Skips routes whose geometry is missing or not valid JSON
+            if not db.has_valid_geometry(item):
+                continue
 
-    return jsonify({
-        'type': 'FeatureCollection',
-        'features': features,
-    })
+            chunk = separator + _serialize_feature(item)
+            separator = b','
+            chunks.append(chunk)
+            yield chunk
+
+        chunks.append(b']}')
+        yield chunks[-1]
+        _cache_put('geojson', version, b''.join(chunks))
+
+    if _accepts_gzip():
+        resp = Response(_gzip_stream(stream()), mimetype='application/json')
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        resp = Response(stream(), mimetype='application/json')
+    resp.vary.add('Accept-Encoding')
+    return resp
 
 
 @api.route('/routes/<route_id>', methods=['GET'])
@@ -48,7 +183,7 @@ def get_route(route_id):
     item = db.get_route(route_id)
     if not item:
         return jsonify({'error': 'Route not found'}), 404
-    return jsonify(item)
+    return _json_response(item)
 
 
 @api.route('/routes', methods=['POST'])
@@ -58,6 +193,7 @@ def create_route():
     if not data or not data.get('name'):
         return jsonify({'error': 'Name is required'}), 400
     item = db.create_route(data)
+    _invalidate_cache()
     return jsonify(item), 201
 
 
@@ -70,6 +206,7 @@ def update_route(route_id):
     item = db.update_route(route_id, data)
     if not item:
         return jsonify({'error': 'Route not found'}), 404
+    _invalidate_cache()
     return jsonify(item)
 
 
@@ -79,6 +216,7 @@ def delete_route(route_id):
     deleted = db.delete_route(route_id)
     if not deleted:
         return jsonify({'error': 'Route not found'}), 404
+    _invalidate_cache()
     return jsonify({'ok': True})
 
 
@@ -97,66 +235,79 @@ def elevation():
         return jsonify({'error': 'No coordinates provided'}), 400
 
     # Round coordinates to 4 decimal places (~11m precision) to keep URLs shorter
-    coords = [[round(c[0], 4), round(c[1], 4)] for c in coords]
+    coords = np.round(np.asarray(coords, dtype=np.float64)[:, :2], 4)
 
     # Open-Meteo handles up to ~100 coords per request; batch if needed
     BATCH_SIZE = 80
-    all_elevations = []
-
-    for i in range(0, len(coords), BATCH_SIZE):
-        batch = coords[i:i + BATCH_SIZE]
-        latitudes = ','.join(str(c[1]) for c in batch)
-        longitudes = ','.join(str(c[0]) for c in batch)
+    batches = [coords[i:i + BATCH_SIZE] for i in range(0, len(coords), BATCH_SIZE)]
+
+    def fetch_batch(batch):
+        return _http.get(
+            'https://api.open-meteo.com/v1/elevation',
+            params={
+                'latitude': ','.join(batch[:, 1].astype(str)),
+                'longitude': ','.join(batch[:, 0].astype(str)),
+            },
+            timeout=15,
+        )
 
-        try:
-            resp = requests.get(
-                'https://api.open-meteo.com/v1/elevation',
-                params={'latitude': latitudes, 'longitude': longitudes},
-                timeout=15,
-            )
+    # Batches are fetched concurrently on a pool owned by this request, so one
+    # long route can't hold up anyone else's; map() yields responses in order
+    executor = ThreadPoolExecutor(max_workers=min(ELEVATION_MAX_WORKERS, len(batches)))
+    all_elevations = []
+    try:
+        for resp in executor.map(fetch_batch, batches):
             if resp.status_code != 200:
                 return jsonify({'error': f'Elevation API returned {resp.status_code}'}), 502
 
             result = resp.json()
-            batch_elevations = result.get('elevation', [])
-            # Replace nulls/NaNs with interpolated or neighbor values
-            for j, v in enumerate(batch_elevations):
-                if v is None:
-                    batch_elevations[j] = 0
-            all_elevations.extend(batch_elevations)
-        except requests.exceptions.Timeout:
-            return jsonify({'error': 'Elevation API timeout'}), 504
-        except Exception as e:
-            return jsonify({'error': str(e)}), 502
-
-    # Interpolate any zero-placeholder values between valid neighbors
-    for i in range(len(all_elevations)):
-        if all_elevations[i] == 0:
-            # Find nearest non-zero neighbors
-            prev_val = next((all_elevations[j] for j in range(i - 1, -1, -1) if all_elevations[j] != 0), None)
-            next_val = next((all_elevations[j] for j in range(i + 1, len(all_elevations)) if all_elevations[j] != 0), None)
-            if prev_val is not None and next_val is not None:
-                all_elevations[i] = (prev_val + next_val) / 2
-            elif prev_val is not None:
-                all_elevations[i] = prev_val
-            elif next_val is not None:
-                all_elevations[i] = next_val
+            all_elevations.extend(result.get('elevation', []))
+    except requests.exceptions.Timeout:
+        return jsonify({'error': 'Elevation API timeout'}), 504
+    except Exception as e:
+        return jsonify({'error': str(e)}), 502
+    finally:
+        # Drop batches that haven't started if we bailed out early
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # Nulls become zero placeholders, which are then linearly interpolated
+    # between their valid neighbors (or take the nearest value at either end)
+    elevations = np.fromiter((v or 0.0 for v in all_elevations), dtype=np.float64,
+                             count=len(all_elevations))
+    valid = np.flatnonzero(elevations)
+    if 0 < len(valid) < len(elevations):
+        elevations = np.interp(np.arange(len(elevations)), valid, elevations[valid])
 
     # Calculate elevation gain (sum of positive deltas)
-    gain = 0.0
-    for i in range(1, len(all_elevations)):
-        delta = all_elevations[i] - all_elevations[i - 1]
-        if delta > 0:
-            gain += delta
+    gain = float(np.clip(np.diff(elevations), 0, None).sum())
 
     return jsonify({
-        'elevations': all_elevations,
+        'elevations': elevations.tolist(),
         'elevation_gain_m': round(gain),
     })
 
 
 # --- GPX export ---
 
+_GPX_HEADER = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="CycleMaps"
+  xmlns="http://www.topografix.com/GPX/1/1"
+  xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+  xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">
+  <metadata>
+    <name>%s</name>
+    <desc>%s</desc>
+  </metadata>
+  <trk>
+    <name>%s</name>
+    <trkseg>
+"""
+_GPX_TRKPT = b'      <trkpt lat="%a" lon="%a"></trkpt>\n'  # %a formats floats like str()
+_GPX_FOOTER = b"""    </trkseg>
+  </trk>
+</gpx>"""
+
+
 @api.route('/routes/<route_id>/gpx', methods=['GET'])
 def export_gpx(route_id):
     """Export a route as a GPX file."""
@@ -164,52 +315,252 @@ def export_gpx(route_id):
     if not item:
         return jsonify({'error': 'Route not found'}), 404
 
-    geometry = json.loads(item.get('geometry', '{}'))
-    coords = geometry.get('coordinates', [])
+    try:
+        geometry = orjson.loads(item.get('geometry') or '{}')
+    except orjson.JSONDecodeError:
+        geometry = {}
+    coords = geometry.get('coordinates', []) if isinstance(geometry, dict) else []
     name = xml_escape(item.get('name', 'Untitled Route'))
     desc = xml_escape(item.get('description', ''))
 
-    trkpts = []
+    buf = bytearray(_GPX_HEADER % (name.encode(), desc.encode(), name.encode()))
     for coord in coords:
-        lng, lat = coord[0], coord[1]
-        trkpts.append(f'      <trkpt lat="{lat}" lon="{lng}"></trkpt>')
-
-    gpx = f"""<?xml version="1.0" encoding="UTF-8"?>
-<gpx version="1.1" creator="CycleMaps"
-  xmlns="http://www.topografix.com/GPX/1/1"
-  xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-  xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">
-  <metadata>
-    <name>{name}</name>
-    <desc>{desc}</desc>
-  </metadata>
-  <trk>
-    <name>{name}</name>
-    <trkseg>
-{chr(10).join(trkpts)}
-    </trkseg>
-  </trk>
-</gpx>"""
+        buf += _GPX_TRKPT % (coord[1], coord[0])
+    buf += _GPX_FOOTER
 
     safe_filename = item.get('name', 'route').replace('"', '').replace('/', '-')
-    return Response(
-        gpx,
+    return _gzip_if_accepted(Response(
+        bytes(buf),
         mimetype='application/gpx+xml',
         headers={'Content-Disposition': f'attachment; filename="{safe_filename}.gpx"'},
-    )
+    ))
 
 
 # --- Surface data proxy (Overpass API) ---
 
+SURFACE_GRID_DEG = 0.001  # Cell size (~100m) of the grid used to bucket way segments
+_GRID_MAX_CELLS = 64      # Segments whose bbox spans more cells are checked for every sample
+
+SURFACE_CACHE_TTL = 3600   # seconds
+SURFACE_CACHE_SIZE = 1024  # entries; least recently used are evicted first
+
+_surface_cache = OrderedDict()  # sample-points digest -> (timestamp, result)
+_surface_cache_lock = threading.Lock()
+
+
+def _surface_cache_get(key):
+    """Return the cached surface result for key, or None if missing or expired."""
+    with _surface_cache_lock:
+        entry = _surface_cache.get(key)
+        if entry and time.monotonic() - entry[0] < SURFACE_CACHE_TTL:
+            _surface_cache.move_to_end(key)
+            return entry[1]
+    return None
+
+
+def _surface_cache_put(key, result):
+    with _surface_cache_lock:
+        _surface_cache[key] = (time.monotonic(), result)
+        _surface_cache.move_to_end(key)
+        while len(_surface_cache) > SURFACE_CACHE_SIZE:
+            _surface_cache.popitem(last=False)
+
+
+def _way_segments(ways):
+    """
+    Flatten the ways into parallel arrays of segment start points, end points
+    and owning way index, as consumed by _nearest_ways.
+    """
+    starts, ends, owners = [], [], []
+    for way_idx, way in enumerate(ways):
+        way_coords = np.asarray(way['coords'], dtype=np.float64)
+        if len(way_coords) < 2:
+            continue
+        starts.append(way_coords[:-1])
+        ends.append(way_coords[1:])
+        owners.append(np.full(len(way_coords) - 1, way_idx))
+    if not owners:
+        empty = np.empty((0, 2))
+        return empty, empty, np.empty(0, dtype=np.intp)
+    return np.concatenate(starts), np.concatenate(ends), np.concatenate(owners)
+
+
+def _build_segment_grid(seg_start, seg_end):
+    """
+    Bucket segments into the grid cells their bounding boxes overlap.
+    Returns (cell_keys, cell_segs, oversized, origin, extent): one sorted cell key
+    per (cell, segment) pair with the matching segment index, the segments too
+    long to bucket, and the first cell and size of the occupied cell range.
+    """
+    lo = np.floor(np.minimum(seg_start, seg_end) / SURFACE_GRID_DEG).astype(np.int64)
+    hi = np.floor(np.maximum(seg_start, seg_end) / SURFACE_GRID_DEG).astype(np.int64)
+    span = hi - lo + 1
+    n_cells = span[:, 0] * span[:, 1]
+    oversized = np.flatnonzero(n_cells > _GRID_MAX_CELLS)
+    bucketed = np.flatnonzero(n_cells <= _GRID_MAX_CELLS)
+    if not len(bucketed):
+        return np.empty(0, np.int64), np.empty(0, np.intp), oversized, (0, 0), (0, 0)
+    origin = lo[bucketed].min(axis=0)
+    extent = hi[bucketed].max(axis=0) - origin + 1
+
+    # Expand every bucketed segment into one entry per cell of its bbox
+    counts = n_cells[bucketed]
+    segs = np.repeat(bucketed, counts)
+    offset = np.arange(len(segs)) - np.repeat(np.cumsum(counts) - counts, counts)
+    height = span[segs, 1]
+    cx = lo[segs, 0] + offset // height
+    cy = lo[segs, 1] + offset % height
+    keys = (cx - origin[0]) * extent[1] + (cy - origin[1])
+    order = np.argsort(keys, kind='stable')
+    return keys[order], segs[order], oversized, tuple(origin.tolist()), tuple(extent.tolist())
+
+
+def _ring_cells(cx, cy, ring):
+    """x and y arrays of the grid cells at Chebyshev distance `ring` from (cx, cy)."""
+    if ring == 0:
+        return np.array([cx]), np.array([cy])
+    side = np.arange(-ring, ring + 1)
+    inner = side[1:-1]
+    xs = np.concatenate((cx + side, cx + side,
+                         np.full(len(inner), cx - ring), np.full(len(inner), cx + ring)))
+    ys = np.concatenate((np.full(len(side), cy - ring), np.full(len(side), cy + ring),
+                         cy + inner, cy + inner))
+    return xs, ys
+
+
+def _grid_candidates(grid, xs, ys):
+    """Indices of the segments bucketed in the given cells."""
+    cell_keys, cell_segs, _, origin, extent = grid
+    gx, gy = xs - origin[0], ys - origin[1]
+    inside = (gx >= 0) & (gx < extent[0]) & (gy >= 0) & (gy < extent[1])
+    keys = gx[inside] * extent[1] + gy[inside]
+    starts = np.searchsorted(cell_keys, keys, side='left').tolist()
+    ends = np.searchsorted(cell_keys, keys, side='right').tolist()
+    parts = [cell_segs[a:b] for a, b in zip(starts, ends) if b > a]
+    return np.concatenate(parts) if parts else cell_segs[:0]
+
+
+def _seg_dist_sq(px, py, seg_start, seg_d, len_sq, idx):
+    """Squared distances from (px, py) to the segments idx, using the closed-form projection."""
+    rel_x = px - seg_start[idx, 0]
+    rel_y = py - seg_start[idx, 1]
+    t = np.clip((rel_x * seg_d[idx, 0] + rel_y * seg_d[idx, 1]) / len_sq[idx], 0.0, 1.0)
+    off_x = rel_x - t * seg_d[idx, 0]
+    off_y = rel_y - t * seg_d[idx, 1]
+    return off_x * off_x + off_y * off_y
+
+
+def _nearest_ways(samples, seg_start, seg_end, seg_way):
+    """
+    Index of the nearest way for each (x, y) row of samples. Each sample searches
+    the segment grid ring by ring outward from its own cell and only evaluates the
+    segments found there; once rings 0..r have been checked, any unseen segment is
+    more than r * SURFACE_GRID_DEG away, so the result matches an exhaustive search.
+    """
+    seg_d = seg_end - seg_start
+    len_sq = (seg_d * seg_d).sum(axis=1)
+    len_sq[len_sq == 0] = 1.0  # Degenerate segments project onto their start point
+
+    grid = _build_segment_grid(seg_start, seg_end)
+    cell_keys, _, oversized, (min_cx, min_cy), (width, height) = grid
+    max_cx, max_cy = min_cx + width - 1, min_cy + height - 1
+
+    nearest = np.empty(len(samples), dtype=seg_way.dtype)
+    for i, (px, py) in enumerate(samples.tolist()):
+        best_dist, best_seg = math.inf, -1
+        if len(oversized):
+            d = _seg_dist_sq(px, py, seg_start, seg_d, len_sq, oversized)
+            j = int(d.argmin())
+            best_dist, best_seg = d[j], oversized[j]
+
+        if len(cell_keys):
+            cx, cy = math.floor(px / SURFACE_GRID_DEG), math.floor(py / SURFACE_GRID_DEG)
+            # Rings closer than the occupied range are empty, so start at its edge
+            first_ring = max(0, min_cx - cx, cx - max_cx, min_cy - cy, cy - max_cy)
+            last_ring = max(cx - min_cx, max_cx - cx, cy - min_cy, max_cy - cy)
+            for ring in range(first_ring, last_ring + 1):
+                candidates = _grid_candidates(grid, *_ring_cells(cx, cy, ring))
+                if len(candidates):
+                    d = _seg_dist_sq(px, py, seg_start, seg_d, len_sq, candidates)
+                    j = int(d.argmin())
+                    if d[j] < best_dist:
+                        best_dist, best_seg = d[j], candidates[j]
+                if best_dist <= (ring * SURFACE_GRID_DEG) ** 2:
+                    break
+
+        nearest[i] = seg_way[best_seg]
+    return nearest
+
+
+def _surface_breakdown(elements, samples):
+    """
+    Match each sample point to its nearest Overpass way and summarize the
+    surface types as percentages of the matched points.
+    """
+    # Build list of ways with their node geometries and surface tags
+    ways = []
+    for el in elements:
+        geom = el.get('geometry', [])
+        if not geom:
+            continue
+        surface_tag = el.get('tags', {}).get('surface', '')
+        way_coords = [(n['lon'], n['lat']) for n in geom]
+        ways.append({'surface': surface_tag, 'coords': way_coords})
+
+    # For each sample point, find the nearest way and record its surface
+    paved_set = {'asphalt', 'paved', 'concrete', 'concrete:plates', 'concrete:lanes',
+                 'cobblestone', 'sett', 'paving_stones', 'metal', 'wood'}
+    gravel_set = {'gravel', 'fine_gravel', 'compacted', 'pebblestone'}
+
+    surface_counts = {'paved': 0, 'gravel': 0, 'dirt': 0}
+    matched = 0
+
+    seg_start, seg_end, seg_way = _way_segments(ways)
+    if len(seg_way):
+        nearest = _nearest_ways(samples, seg_start, seg_end, seg_way).tolist()
+        sampled_surfaces = [ways[way_idx]['surface'] for way_idx in nearest]
+    else:
+        sampled_surfaces = [''] * len(samples)
+
+    for best_surface in sampled_surfaces:
+        if best_surface:
+            matched += 1
+            if best_surface in paved_set:
+                surface_counts['paved'] += 1
+            elif best_surface in gravel_set:
+                surface_counts['gravel'] += 1
+            else:
+                surface_counts['dirt'] += 1
+        else:
+            # Way exists but no surface tag — assume paved (most common for highways)
+            matched += 1
+            surface_counts['paved'] += 1
+
+    if matched == 0:
+        return {'breakdown': [], 'total_points': 0}
+
+    breakdown = []
+    for stype in ['paved', 'gravel', 'dirt']:
+        if surface_counts[stype] > 0:
+            breakdown.append({
+                'type': stype,
+                'percentage': round(surface_counts[stype] / matched * 100),
+            })
+
+    return {
+        'breakdown': breakdown,
+        'total_points': matched,
+    }
+
+
 @api.route('/surface', methods=['POST'])
 def surface():
     """
     Query Overpass API for surface tags along a route.
-    Expects JSON body: { "coordinates": [[lng, lat], ...] }
-    Returns surface type breakdown weighted by route distance.
+    Expects JSON body: { "coordinates": [[lng, lat], ...], "route_id": optional }
+    Returns surface type breakdown weighted by route distance. When route_id
+    is given, the result is also saved as that route's surface_data.
     """
-    import math
-
     data = request.get_json()
     coords = data.get('coordinates', [])
     if not coords or len(coords) < 2:
@@ -220,104 +571,43 @@ def surface():
     sampled = coords[::step]
     if sampled[-1] != coords[-1]:
         sampled.append(coords[-1])
+    samples = np.asarray(sampled, dtype=np.float64)[:, :2]
 
-    # Query Overpass for ways WITH geometry so we can match points to ways
-    coord_str = ','.join(f'{c[1]},{c[0]}' for c in sampled)
-    query = f'[out:json][timeout:20];way(around:10,{coord_str})[highway];out body geom;'
-
-    try:
-        resp = requests.post(
-            'https://overpass-api.de/api/interpreter',
-            data={'data': query},
-            timeout=25,
-        )
-        if resp.status_code != 200:
-            return jsonify({'error': f'Overpass returned {resp.status_code}'}), 502
-
-        result = resp.json()
-        elements = result.get('elements', [])
+    # Identical routes sample to identical points, so key the cache on them
+    cache_key = hashlib.blake2b(samples.tobytes(), digest_size=16).digest()
+    result = _surface_cache_get(cache_key)
+    if result is None:
+        # Query Overpass for ways WITH geometry so we can match points to ways
+        coord_str = ','.join(f'{c[1]},{c[0]}' for c in sampled)
+        query = f'[out:json][timeout:20];way(around:10,{coord_str})[highway];out body geom;'
 
-        if not elements:
-            return jsonify({'breakdown': [], 'total_points': 0})
-
-        # Build list of ways with their node geometries and surface tags
-        ways = []
-        for el in elements:
-            geom = el.get('geometry', [])
-            if not geom:
-                continue
-            surface_tag = el.get('tags', {}).get('surface', '')
-            way_coords = [(n['lon'], n['lat']) for n in geom]
-            ways.append({'surface': surface_tag, 'coords': way_coords})
-
-        def point_to_seg_dist_sq(px, py, ax, ay, bx, by):
-            """Squared distance from point (px,py) to segment (ax,ay)-(bx,by)."""
-            dx, dy = bx - ax, by - ay
-            if dx == 0 and dy == 0:
-                return (px - ax) ** 2 + (py - ay) ** 2
-            t = max(0, min(1, ((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy)))
-            proj_x, proj_y = ax + t * dx, ay + t * dy
-            return (px - proj_x) ** 2 + (py - proj_y) ** 2
-
-        def min_dist_to_way(point, way_coords):
-            """Minimum distance from a point to any segment in a way."""
-            px, py = point
-            best = float('inf')
-            for i in range(len(way_coords) - 1):
-                d = point_to_seg_dist_sq(px, py, way_coords[i][0], way_coords[i][1],
-                                         way_coords[i+1][0], way_coords[i+1][1])
-                if d < best:
-                    best = d
-            return best
-
-        # For each sample point, find the nearest way and record its surface
-        paved_set = {'asphalt', 'paved', 'concrete', 'concrete:plates', 'concrete:lanes',
-                     'cobblestone', 'sett', 'paving_stones', 'metal', 'wood'}
-        gravel_set = {'gravel', 'fine_gravel', 'compacted', 'pebblestone'}
-
-        surface_counts = {'paved': 0, 'gravel': 0, 'dirt': 0}
-        matched = 0
-
-        for pt in sampled:
-            lng, lat = pt[0], pt[1]
-            best_dist = float('inf')
-            best_surface = ''
-            for way in ways:
-                d = min_dist_to_way((lng, lat), way['coords'])
-                if d < best_dist:
-                    best_dist = d
-                    best_surface = way['surface']
-
-            if best_surface:
-                matched += 1
-                if best_surface in paved_set:
-                    surface_counts['paved'] += 1
-                elif best_surface in gravel_set:
-                    surface_counts['gravel'] += 1
-                else:
-                    surface_counts['dirt'] += 1
-            else:
-                # Way exists but no surface tag — assume paved (most common for highways)
-                matched += 1
-                surface_counts['paved'] += 1
+        try:
+            resp = _http.post(
+                'https://overpass-api.de/api/interpreter',
+                data={'data': query},
+                timeout=25,
+            )
+            if resp.status_code != 200:
+                return jsonify({'error': f'Overpass returned {resp.status_code}'}), 502
 
-        if matched == 0:
-            return jsonify({'breakdown': [], 'total_points': 0})
+            elements = resp.json().get('elements', [])
+            if not elements:
+                return jsonify({'breakdown': [], 'total_points': 0})
 
-        breakdown = []
-        for stype in ['paved', 'gravel', 'dirt']:
-            if surface_counts[stype] > 0:
-                breakdown.append({
-                    'type': stype,
-                    'percentage': round(surface_counts[stype] / matched * 100),
-                })
+            result = _surface_breakdown(elements, samples)
+        except requests.exceptions.Timeout:
+            return jsonify({'error': 'Overpass timeout'}), 504
+        except Exception as e:
+            return jsonify({'error': str(e)}), 502
+        _surface_cache_put(cache_key, result)
 
-        return jsonify({
-            'breakdown': breakdown,
-            'total_points': matched,
-        })
+    # Saving to the route is a side effect; the lookup has already succeeded
+    route_id = data.get('route_id')
+    if isinstance(route_id, str) and route_id and result['breakdown']:
+        try:
+            if db.set_surface_data(route_id, orjson.dumps(result).decode()):
+                _invalidate_cache()
+        except Exception as e:
+            print(f'[Surface] Could not save surface data for route {route_id} ({type(e).__name__}: {e})')
 
-    except requests.exceptions.Timeout:
-        return jsonify({'error': 'Overpass timeout'}), 504
-    except Exception as e:
-        return jsonify({'error': str(e)}), 502
+    return jsonify(result)
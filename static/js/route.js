@@ -250,10 +250,11 @@ async function fetchSurface() {
   if (coords.length < 2) return;
 
   try {
+    // Passing route_id lets the server save the result as this route's surface_data
     const resp = await fetch('/api/surface', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ coordinates: coords }),
+      body: JSON.stringify({ coordinates: coords, route_id: routeData.id }),
     });
     if (!resp.ok) return;
     const data = await resp.json();